@@ -22,113 +22,207 @@ from __future__ import unicode_literals
 
 import os
 import cv2
+import math
 import logging
 import numpy as np
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from tempfile import TemporaryDirectory
 from cytomine import CytomineJob
 from cytomine.models import ImageInstance, ImageInstanceCollection, AnnotationCollection, Annotation
+from cytomine.models.collection import CollectionPartialUploadException
 from cytomine.utilities.software import parse_domain_list
 from shapely.geometry import Polygon
-from sldc.locator import mask_to_objects_2d
+from shapely.validation import make_valid
 from shapely.affinity import affine_transform
-from skimage.filters import threshold_otsu
 
 __author__ = "WSHMunirah WAhmad <wshmunirah@gmail.com>"
 
+logger = logging.getLogger(__name__)
+
+ANNOTATION_BATCH_SIZE = 500
+UPLOAD_WORKERS = 2
+FETCH_WORKERS = 16
+MAX_SEGMENTATION_WORKERS = 4
+CROSS_KERNEL = cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
+
+
+def mask_to_polygons(mask):
+    """Extract the foreground (non-zero) objects of a mask as shapely polygons (with holes)"""
+    contours, hierarchy = cv2.findContours(mask, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_TC89_L1)
+    if hierarchy is None:
+        return []
+    hierarchy = hierarchy[0]
+
+    # contours run through the centres of the boundary pixels; shift them by half a pixel
+    # to stay closer to the pixel-edge polygons previously produced by sldc
+    polygons = []
+    for i, contour in enumerate(contours):
+        # with RETR_CCOMP, outer contours have no parent and their holes are their children
+        if hierarchy[i][3] != -1 or len(contour) < 3:
+            continue
+        holes = []
+        child = hierarchy[i][2]
+        while child != -1:
+            if len(contours[child]) >= 3:
+                holes.append(contours[child][:, 0, :] + 0.5)
+            child = hierarchy[child][0]
+        polygon = Polygon(shell=contour[:, 0, :] + 0.5, holes=holes)
+        if not polygon.is_valid:
+            # 8-connected contours can touch themselves, split them into valid polygons.
+            # make_valid may nest them, e.g. GEOMETRYCOLLECTION(MULTIPOLYGON(...), LINESTRING(...))
+            polygon = make_valid(polygon)
+            polygons.extend(
+                p for g in getattr(polygon, "geoms", [polygon])
+                for p in getattr(g, "geoms", [g])
+                if isinstance(p, Polygon)
+            )
+        else:
+            polygons.append(polygon)
+    return polygons
+
+
+def clean_mask(mask, kernel_size, min_region_size):
+    """Remove small components from a binary mask, then open it"""
+    _, output, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    # Look-up table indexed by label: True for components to remove (background is kept)
+    kill = stats[:, cv2.CC_STAT_AREA] < min_region_size
+    kill[0] = False
+    mask[kill[output]] = 0
+
+    # Opening with a 1x1 element is the identity
+    if max(kernel_size) <= 1:
+        return mask
+    if kernel_size[0] == kernel_size[1] and kernel_size[0] % 2 == 1:
+        # k//2 iterations of a 3x3 cross span the same (2*(k//2)+1) extent as an odd k x k ellipse,
+        # approximating it at a fraction of the cost for large kernels
+        return cv2.morphologyEx(mask, cv2.MORPH_OPEN, CROSS_KERNEL, iterations=max(1, kernel_size[0] // 2))
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, kernel_size)
+    return cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+
+
+def load_image(image, max_image_size):
+    """Download a grayscale version of the image, resized to fit max_image_size.
+    Returns the image and its resized width"""
+    # Resize image if needed
+    resize_ratio = max(image.width, image.height) / max_image_size
+    if resize_ratio < 1:
+        resize_ratio = 1
+
+    resized_width = int(image.width / resize_ratio)
+    resized_height = int(image.height / resize_ratio)
+
+    bit_depth = image.bitDepth if image.bitDepth is not None else 8
+
+    # download file in a temporary directory for auto-removal
+    with TemporaryDirectory() as tmpdir:
+        download_path = os.path.join(tmpdir, "{id}.png")
+        image.dump(dest_pattern=download_path, max_size=max(resized_width, resized_height), bits=bit_depth)
+        img = cv2.imread(download_path.format(id=image.id), cv2.IMREAD_GRAYSCALE)
+    return img, resized_width
+
+
+def segment_image(img, threshold_allowance, kernel_size, min_region_size):
+    """Segment the tissue of a grayscale image. Returns the foreground polygons, in pixel coordinates"""
+    th_value, _ = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    logger.debug("Otsu threshold: %s", th_value)
+    threshold = th_value + threshold_allowance
+    logger.debug("Otsu threshold + allowance: %s", threshold)
+    # img < threshold  <=>  img <= ceil(threshold) - 1, in a single pass
+    _, thresh_mask = cv2.threshold(img, math.ceil(threshold) - 1, 255, cv2.THRESH_BINARY_INV)
+    # Nothing to label, open or trace on a blank mask
+    if cv2.countNonZero(thresh_mask) == 0:
+        return []
+    thresh_mask = clean_mask(thresh_mask, kernel_size, min_region_size)
+
+    # extract foreground polygons (no padding needed: findContours traces pixels on the image border)
+    return mask_to_polygons(thresh_mask)
+
+
+def detect_tissue(image, parameters, kernel_size, min_region_size, executor):
+    """Download an image and segment it in the process pool. Returns the polygons and their zoom factor"""
+    img, resized_width = load_image(image, parameters.max_image_size)
+    fg_objects = executor.submit(
+        segment_image, img, parameters.threshold_allowance, kernel_size, min_region_size
+    ).result()
+    return fg_objects, image.width / float(resized_width)
+
+
+def upload_annotations(image, fg_objects, zoom_factor, parameters):
+    """Upload the polygons found in an image as annotations. Returns the number of annotations"""
+    # Only keep components greater than {image_area_perc_threshold}% of whole image
+    min_area = int((parameters.image_area_perc_threshold / 100) * image.width * image.height)
+
+    transform_matrix = [zoom_factor, 0, 0, -zoom_factor, 0, image.height]
+    annotations = AnnotationCollection()
+    for fg_poly in fg_objects:
+        # area scales by zoom_factor^2 with the transform, so filter before transforming
+        if fg_poly.area * zoom_factor ** 2 <= min_area:
+            continue
+        upscaled = affine_transform(fg_poly, transform_matrix)
+        # drop per-pixel vertices to shrink the WKT payload, tolerance follows the zoom
+        upscaled = upscaled.simplify(tolerance=max(1.0, zoom_factor), preserve_topology=True)
+        logger.debug("Mask area: %s", upscaled.area)
+        annotations.append(Annotation(
+            location=upscaled.wkt,
+            id_image=image.id,
+            id_terms=[parameters.cytomine_id_predicted_term],
+            id_project=parameters.cytomine_id_project))
+
+    if len(annotations) == 0:
+        return 0
+
+    # Upload in batches of ANNOTATION_BATCH_SIZE annotations per request instead of one request each
+    try:
+        annotations.save(chunk=ANNOTATION_BATCH_SIZE, n_workers=UPLOAD_WORKERS)
+    except CollectionPartialUploadException as e:
+        logger.error("Failed to upload %d annotations. Proceed with next image", len(e.failed))
+    return len(annotations)
+
+
 def main(argv):
     with CytomineJob.from_cli(argv) as cj:
         
         images = ImageInstanceCollection()
         if cj.parameters.cytomine_id_images is not None:
             id_images = parse_domain_list(cj.parameters.cytomine_id_images)
-            images.extend([ImageInstance().fetch(_id) for _id in id_images])
+            # metadata requests are I/O bound, issue them concurrently
+            with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+                images.extend(executor.map(lambda _id: ImageInstance().fetch(_id), id_images))
         else:
             images = images.fetch_with_filter("project", cj.parameters.cytomine_id_project)
         
-        for image in cj.monitor(images, prefix="Running detection on image", period=0.1):
-            # Resize image if needed
-            resize_ratio = max(image.width, image.height) / cj.parameters.max_image_size
-            if resize_ratio < 1:
-                resize_ratio = 1
-
-            resized_width = int(image.width / resize_ratio)
-            resized_height = int(image.height / resize_ratio)
-
-            bit_depth = image.bitDepth if image.bitDepth is not None else 8
-            
-            # download file in a temporary directory for auto-removal
-            with TemporaryDirectory() as tmpdir:
-                download_path = os.path.join(tmpdir, "{id}.png")
-                image.dump(dest_pattern=download_path, max_size=max(resized_width, resized_height), bits=bit_depth)
-                img = cv2.imread(image.filename, cv2.IMREAD_GRAYSCALE)
-
-            dim = (resized_width, resized_height)    
-            im_resized = cv2.resize(img, dim, interpolation = cv2.INTER_AREA)
-            pixels = np.array(im_resized).flatten()
-            th_value = threshold_otsu(pixels)
-            print("Otsu threshold: ", th_value)
-            threshold = th_value + cj.parameters.threshold_allowance
-            print("Otsu threshold + allowance: ", threshold)
-            thresh_mask = (img < threshold).astype(np.uint8)*255
-          
-            kernel_size = np.array(cj.parameters.kernel_size)
-            if kernel_size.size != 2:  # noqa: PLR2004
-              kernel_size = kernel_size.repeat(2)
-            kernel_size = tuple(np.round(kernel_size).astype(int))
-          
-            # Create structuring element for morphological operations
-            kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, kernel_size)
-            min_region_size = np.sum(kernel)
-            _, output, stats, _ = cv2.connectedComponentsWithStats(thresh_mask, connectivity=8)
-            sizes = stats[1:, -1]
-            for i, size in enumerate(sizes):
-                if size < min_region_size:
-                    thresh_mask[output == i + 1] = 0
-
-            thresh_mask = cv2.morphologyEx(thresh_mask, cv2.MORPH_OPEN, kernel)
-            thresh_mask = cv2.bitwise_not(thresh_mask)            
- 
-            extension = 10
-            extended_img = cv2.copyMakeBorder(
-                thresh_mask,
-                extension,
-                extension,
-                extension,
-                extension,
-                cv2.BORDER_CONSTANT,
-                value=255  # Use the same as the background value
-            )
-
-            h, w = thresh_mask.shape
-            edges = np.zeros_like(thresh_mask)
-            edges[0, :] = edges[-1, :] = edges[:, 0] = edges[:, -1] = 1
-            
-            mask_edges = cv2.bitwise_and(thresh_mask, edges)
-            thresh_mask[mask_edges > 0] = 0
-
-            # extract foreground polygons 
-            fg_objects = mask_to_objects_2d(extended_img, background=255, offset=(-extension, -extension))
-            zoom_factor = image.width / float(resized_width)
-
-            # Only keep components greater than {image_area_perc_threshold}% of whole image
-            min_area = int((cj.parameters.image_area_perc_threshold / 100) * image.width * image.height)
-
-            transform_matrix = [zoom_factor, 0, 0, -zoom_factor, 0, image.height]
-            annotations = AnnotationCollection()
-            for i, (fg_poly, _) in enumerate(fg_objects):
-                upscaled = affine_transform(fg_poly, transform_matrix)
-                if upscaled.area <= min_area:
-                    continue
-                # print(upscaled.area)
-                try:
-                    print("Mask area: ", upscaled.area)
-                    Annotation(
-                    location=upscaled.wkt,
-                    id_image=image.id,
-                    id_terms=[cj.parameters.cytomine_id_predicted_term],
-                    id_project=cj.parameters.cytomine_id_project).save()                    
-                except:
-                    print("An exception occurred. Proceed with next annotations")
+        kernel_size = np.array(cj.parameters.kernel_size)
+        if kernel_size.size != 2:  # noqa: PLR2004
+          kernel_size = kernel_size.repeat(2)
+        kernel_size = tuple(np.round(kernel_size).astype(int))
+
+        # Area of the elliptic structuring element, computed once per job
+        min_region_size = int(np.count_nonzero(cv2.getStructuringElement(cv2.MORPH_ELLIPSE, kernel_size)))
+
+        # Images are independent: they are segmented in parallel in a process pool while the next ones
+        # are downloaded. All the HTTP traffic (downloads and uploads) stays in this process, the workers
+        # only receive decoded images and are spawned so they share no connection with it.
+        # Each worker holds a few full-size arrays, hence the cap on their number.
+        n_workers = max(1, min(len(os.sched_getaffinity(0)), MAX_SEGMENTATION_WORKERS, len(images)))
+        spawn = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=spawn) as executor, \
+                ThreadPoolExecutor(max_workers=n_workers + 1) as downloader:
+            futures = {
+                downloader.submit(detect_tissue, image, cj.parameters, kernel_size, min_region_size, executor): image
+                for image in images
+            }
+            completed = as_completed(futures)
+            try:
+                for _ in cj.monitor(list(futures), prefix="Running detection on image", period=0.1):
+                    future = next(completed)
+                    fg_objects, zoom_factor = future.result()
+                    upload_annotations(futures[future], fg_objects, zoom_factor, cj.parameters)
+            except:
+                # fail fast: do not download and segment the remaining images on the way out
+                for future in futures:
+                    future.cancel()
+                raise
 
         cj.job.update(statusComment="Finished.")
 
@@ -0,0 +1,18 @@
+import numpy as np
+
+from run import mask_to_polygons
+
+
+def test_mask_to_polygons_keeps_self_touching_contours():
+    # two blocks touching by a corner, plus a one pixel wide tail: make_valid returns
+    # GEOMETRYCOLLECTION(MULTIPOLYGON(...), LINESTRING(...)) for this contour
+    mask = np.zeros((20, 20), dtype=np.uint8)
+    mask[2:8, 2:8] = 255
+    mask[8:14, 8:14] = 255
+    mask[2:8, 9:14] = 255
+    mask[14:18, 13] = 255
+
+    polygons = mask_to_polygons(mask)
+
+    assert all(p.is_valid for p in polygons)
+    assert sum(p.area for p in polygons) >= 0.75 * np.count_nonzero(mask)